@@ -0,0 +1,169 @@
+import math
+import numpy as np
+from numba import njit, prange, set_num_threads
+from numba.typed import List
+
+# Number of consecutive paths sharing the same stream of random numbers
+_BLOCK_SIZE = 256
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _simulate(S, mu, sigma, Lambda, a, b, Delta_t, Nsteps, Nsim, Nkeep,
+              generators):
+    '''
+    Compiled kernel simulating Nsim paths of Merton's jump diffusion model. It
+    returns the array of the Nsim simulated prices at maturity, together with
+    the Nkeep x (Nsteps+1) array of the first Nkeep full paths. Each row of the
+    matrix represents a full, possible path for the stock, each column all
+    values of the asset at a particular instant in time.
+
+    Only the terminal prices are needed to compute Monte Carlo estimates, and
+    only a few full paths to plot them: storing just these keeps the memory
+    footprint of the simulation at about 8*Nsim bytes, rather than
+    4*Nsim*(Nsteps+1), i.e. 8 MB instead of 1 GB for 1,000,000 paths of 252
+    time steps.
+
+    Paths are independent of each other, so they are distributed across all
+    available cores with prange; each of them is then populated with a plain
+    loop over the monitoring dates. Every thread thus writes whole rows of the
+    matrix, which are contiguous in the default row-major (C) order. Random
+    variables are drawn inline, one at a time, so that no Nsim x Nsteps array
+    of them is ever stored in memory.
+
+    To account for the multiple sources of uncertainty in the jump diffusion
+    process, three random variables would be required at each time step.
+
+     - The first one is related to the standard Brownian motion, the component
+       epsilon(0,1) in epsilon(0,1) * np.sqrt(dt);
+     - The second and third ones model the jump, a compound Poisson process:
+       the former (a Poisson process with intensity Lambda) causes the asset
+       price to jump randomly (random timing); the latter (a Gaussian variable)
+       defines both the direction (sign) and intensity (magnitude) of the jump.
+
+    Given the number of jumps N in the time step, however, the two Gaussian
+    components sigma*sqrt(dt)*Z_1 and b*sqrt(N)*Z_2 are independent, and their
+    sum is itself Gaussian, with mean 0 and variance sigma**2*dt + b**2*N. A
+    single standard Normal variable Z, scaled by the square root of the latter,
+    is then enough to generate both, halving the number of Gaussian draws.
+
+    For typical parameter values, Lambda*dt is small, and the vast majority of
+    time steps have no jumps at all. Rather than drawing one Poisson variable
+    per time step, the total number of jumps over the whole path is then drawn
+    at once, from a Poisson distribution with mean Lambda*T. Given their
+    number, the arrival times of the jumps are independent and uniformly
+    distributed on [0, T], so that each of them is simply assigned to a random
+    time step, and N is the number of jumps assigned to a step. Only about
+    Lambda*T + 1 random variables per path are then needed for the jump
+    component, instead of Nsteps. When jumps are expected at most time steps
+    (Lambda*dt > 1), the standard Poisson generator is used at each step.
+
+    Random variables are drawn from PCG64 generators (NumPy's Generator API),
+    several times faster than the legacy Mersenne Twister. A generator cannot
+    be shared among threads, so paths are grouped into blocks of _BLOCK_SIZE
+    consecutive paths, block j being generated from generators[j], seeded
+    with its own independent seed sequence. prange then distributes blocks,
+    rather than single paths, across threads: since each block always draws
+    from the same stream, results do not depend on the number of threads.
+
+    Rather than multiplying the price by exp(log-return) at each time step,
+    log-returns are accumulated, and the exponential is only taken when a
+    price has to be stored: once per path, at maturity, for all but the first
+    Nkeep paths. Each update of the cumulative log-return is a chain of
+    a + b*c terms, which fastmath allows LLVM to contract into fused
+    multiply-add instructions where the CPU supports them (Numba compiles for
+    the host CPU by default; see NUMBA_CPU_NAME and NUMBA_CPU_FEATURES).
+
+    Full paths are stored in single precision, which halves the memory
+    footprint and bandwidth of the array: the rounding error is negligible
+    compared to the Monte Carlo one. The recursion itself is carried out in
+    double precision, so that rounding errors do not accumulate over time, and
+    terminal prices are returned in double precision as well.
+
+    The matrix is filled as a flat, one-dimensional buffer, path k occupying
+    the Nsteps+1 consecutive elements starting at k*(Nsteps+1): every write is
+    then a single offset from the start of the path, rather than a full
+    two-dimensional index computation. The buffer is only reshaped into an
+    Nkeep x (Nsteps+1) matrix, without copying, on return.
+    '''
+    final_prices = np.empty(Nsim)
+    simulated_paths = np.empty(Nkeep*(Nsteps+1), dtype=np.float32)
+
+    # Compute the loop-invariant coefficients of the recursion only once
+    drift = (mu - 0.5*sigma*sigma)*Delta_t
+    var_diffusion = sigma*sigma*Delta_t
+    var_jump = b*b
+    Lambda_dt = Lambda*Delta_t
+    Lambda_T = Lambda_dt*Nsteps
+    batch = Lambda_dt <= 1
+
+    '''
+    Tabulate the volatility of the single-step log-return for the most likely
+    numbers of jumps, N = 0, 1, ..., 15, so that its square root only has to be
+    computed in the (extremely rare) time steps with more jumps
+    '''
+    vol = np.sqrt(var_diffusion + var_jump*np.arange(16))
+
+    for j in prange(len(generators)):
+        # prange indices are unsigned, typed lists are indexed by signed ones
+        rng = generators[np.intp(j)]
+
+        # Number of jumps at each time step of the current path
+        jumps = np.zeros(Nsteps, dtype=np.int64)
+
+        for k in range(j*_BLOCK_SIZE, min((j+1)*_BLOCK_SIZE, Nsim)):
+            keep = k < Nkeep
+            base = k*(Nsteps+1)
+            log_return = 0.0
+
+            if keep:
+                simulated_paths[base] = S
+
+            if batch:
+                jumps[:] = 0
+                for n in range(rng.poisson(Lambda_T)):
+                    jumps[min(int(rng.random()*Nsteps), Nsteps-1)] += 1
+
+            for i in range(Nsteps):
+                Z = rng.standard_normal()
+
+                if batch:
+                    Poisson = jumps[i]
+                else:
+                    Poisson = rng.poisson(Lambda_dt)
+
+                if Poisson < 16:
+                    vol_N = vol[Poisson]
+                else:
+                    vol_N = math.sqrt(var_diffusion + var_jump*Poisson)
+
+                log_return = log_return + drift + a*Poisson + vol_N*Z
+
+                if keep:
+                    simulated_paths[base+i+1] = S*math.exp(log_return)
+
+            final_prices[k] = S*math.exp(log_return)
+
+    return final_prices, simulated_paths.reshape((Nkeep, Nsteps+1))
+
+
+def _generators(seed_sequences):
+    '''
+    Create one PCG64 generator for each seed sequence, and collect them in a
+    typed list, which the compiled kernel can index.
+    '''
+    return List([np.random.Generator(np.random.PCG64(seed_sequence))
+                 for seed_sequence in seed_sequences])
+
+
+def _worker(args):
+    '''
+    Generate a chunk of simulated paths in a separate process. The first
+    element of args is the number of threads the kernel may use in the worker,
+    so that the pool does not oversubscribe the available cores; the last one
+    contains the seed sequences of the blocks of paths in the chunk, from which
+    the worker creates its own generators; the remaining ones are passed on to
+    _simulate.
+    '''
+    threads, *params, seed_sequences = args
+    set_num_threads(threads)
+    return _simulate(*params, _generators(seed_sequences))
@@ -1,5 +1,204 @@
+import time
+import multiprocessing
+import numpy as np
+from numba import config
+from _jdm_kernel import _BLOCK_SIZE, _simulate, _generators, _worker
+
+# Maximum number of paths simulated at once on the GPU
+_GPU_BATCH_SIZE = 2**16
+
+
+def _simulate_gpu(S, mu, sigma, Lambda, a, b, Delta_t, Nsteps, Nsim, Nkeep,
+                  seed):
+    '''
+    Counterpart of _simulate running on a CUDA GPU through CuPy, an optional
+    dependency only imported here. It returns the same arrays as the former,
+    i.e. the Nsim simulated prices at maturity and the first Nkeep full paths,
+    as NumPy arrays.
+
+    Paths are simulated in batches of at most _GPU_BATCH_SIZE, so that the
+    memory required on the device does not grow with Nsim. For each batch, the
+    whole matrix of single-step log-returns is generated at once, each array
+    operation running as a single CUDA kernel. The cumulative sum along the
+    time axis is only computed for the paths stored in full, since terminal
+    prices only depend on the total log-return of each path. Random numbers
+    come from CuPy's own generator: for the same seed, results differ from
+    those obtained on the CPU.
+    '''
+    import cupy as cp
+
+    random_state = cp.random.RandomState(seed)
+
+    # Compute the coefficients of the single-step log-returns only once
+    drift = (mu - 0.5*sigma*sigma)*Delta_t
+    var_diffusion = sigma*sigma*Delta_t
+    var_jump = b*b
+
+    final_prices = np.empty(Nsim)
+    simulated_paths = np.empty((Nkeep, Nsteps+1), dtype=np.float32)
+    simulated_paths[:,0] = S
+
+    for start in range(0, Nsim, _GPU_BATCH_SIZE):
+        size = min(_GPU_BATCH_SIZE, Nsim - start)
+        Poisson = random_state.poisson(Lambda*Delta_t, (size, Nsteps))
+        Poisson = Poisson.astype(cp.float32)
+        Z = random_state.standard_normal((size, Nsteps), dtype=cp.float32)
+        log_returns = drift + a*Poisson \
+                      + cp.sqrt(var_diffusion + var_jump*Poisson) * Z
+
+        # Store the paths of the batch, if any, among the first Nkeep ones
+        keep = min(max(Nkeep - start, 0), size)
+        if keep > 0:
+            cumulative = cp.cumsum(log_returns[:keep], axis=1)
+            simulated_paths[start:start+keep,1:] = cp.asnumpy(S \
+                                                   * cp.exp(cumulative))
+
+        total = log_returns.sum(axis=1, dtype=cp.float64)
+        final_prices[start:start+size] = cp.asnumpy(S*cp.exp(total))
+
+    return final_prices, simulated_paths
+
+
+def simulate(S=1, T=1, mu=0.12, sigma=0.3, Lambda=0.25, a=0.2, b=0.2,
+             Nsteps=252, Nsim=100, seed=None, processes=None, Nkeep=None,
+             use_gpu=False):
+    '''
+    Generate Nsim random stock price paths of length Nsteps under Merton's jump
+    diffusion model, without computing statistics or drawing any figure. Useful
+    to time the simulation alone, or to repeat it many times (e.g. in a
+    sensitivity analysis).
+
+    Input
+    ---------------------------------------------------------------------------
+    S, T, mu, sigma, Lambda, a, b, Nsteps, Nsim, seed, processes, use_gpu: see
+    jump_diffusion.
+    Nkeep: int. The number of paths stored in full, which are the first Nkeep
+           ones. Default value is None (all Nsim paths are stored).
+
+    Output
+    ---------------------------------------------------------------------------
+    final_prices: NumPy array of shape (Nsim,). The simulated prices at
+                  maturity T.
+    simulated_paths: NumPy array of shape (Nkeep, Nsteps+1), in single
+                     precision. The first Nkeep simulated paths.
+    '''
+
+    # Check that the simulations can be split among the worker processes
+    if processes is not None and processes < 1:
+        raise ValueError('processes must be None or a positive integer, got '
+                         '{}'.format(processes))
+
+    # With no simulations, there is no block of paths to seed and generate
+    if Nsim == 0:
+        return np.empty(0), np.empty((0, Nsteps+1), dtype=np.float32)
+
+    '''
+    Set random seed, and spawn from it one independent seed sequence for each
+    block of paths. Each block is then simulated with its own PCG64 stream,
+    whatever the number of threads or processes among which blocks are split.
+    Since the first children spawned from a seed are always the same, the first
+    paths of a simulation are also identical to those of a larger one.
+    '''
+    Nblocks = -(-Nsim // _BLOCK_SIZE)
+    seed_sequences = np.random.SeedSequence(seed).spawn(Nblocks)
+
+    # Calculate the length of the time step
+    Delta_t = T/Nsteps
+
+    if Nkeep is None:
+        Nkeep = Nsim
+    Nkeep = min(Nsim, Nkeep)
+
+    if use_gpu:
+        final_prices, simulated_paths = _simulate_gpu(float(S), mu, sigma,
+                                                      Lambda, a, b, Delta_t,
+                                                      Nsteps, Nsim, Nkeep,
+                                                      seed)
+
+    elif processes is None:
+        final_prices, simulated_paths = _simulate(float(S), mu, sigma, Lambda,
+                                                  a, b, Delta_t, Nsteps, Nsim,
+                                                  Nkeep,
+                                                  _generators(seed_sequences))
+
+    else:
+        '''
+        Split the blocks of paths into as many contiguous chunks as processes,
+        and generate each of them in a separate worker, together with the
+        seed sequences of its blocks. Every path is then drawn from the same
+        stream of random numbers as in the single-process case. The chunks are
+        then stacked back together in their original order. Workers are
+        started with the 'spawn' method, since forking a process in which the
+        Numba threading layer is already running is not safe.
+        '''
+        processes = min(processes, len(seed_sequences))
+        bounds = np.linspace(0, len(seed_sequences), processes+1).astype(int)
+        first = bounds*_BLOCK_SIZE
+        threads = max(1, config.NUMBA_NUM_THREADS // processes)
+        tasks = [(threads, float(S), mu, sigma, Lambda, a, b, Delta_t, Nsteps,
+                  min(first[i+1], Nsim) - first[i],
+                  min(max(Nkeep - first[i], 0), first[i+1] - first[i]),
+                  seed_sequences[bounds[i]:bounds[i+1]])
+                 for i in range(processes)]
+
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            chunks = pool.map(_worker, tasks)
+
+        final_prices = np.concatenate([chunk[0] for chunk in chunks])
+        simulated_paths = np.vstack([chunk[1] for chunk in chunks])
+
+    return final_prices, simulated_paths
+
+
+def plot_paths(simulated_paths, S=1, T=1, mu=0.12, sigma=0.3, Lambda=0.25,
+               a=0.2, b=0.2, Nsteps=252, Nsim=100):
+    '''
+    Draw the simulated stock price paths of Merton's jump diffusion model.
+
+    Input
+    ---------------------------------------------------------------------------
+    simulated_paths: NumPy array of shape (Npaths, Nsteps+1). The paths to be
+                     drawn, e.g. as returned by simulate.
+    S, T, mu, sigma, Lambda, a, b, Nsteps, Nsim: see jump_diffusion. Only used
+    in the title of the figure.
+    '''
+
+    '''
+    Import the plotting libraries only here. Worker processes, started with
+    the 'spawn' method, re-import the main script and hence this module:
+    importing them at module level would make every pooled call pay for them.
+    '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # Choose palette, figure size, and define figure axes
+    sns.set(palette='viridis')
+    plt.figure(figsize=(10,8))
+    ax = plt.axes()
+
+    # Generate t, the time variable on the abscissae
+    t = np.linspace(0, T, Nsteps+1) * Nsteps
+
+    # Plot the Monte Carlo simulated stock price paths
+    lines = ax.plot(t, simulated_paths.transpose());
+
+    # Make drawn paths thinner by decreasing line width
+    plt.setp(lines, linewidth=1);
+
+    # Set title (LaTeX notation) and x- and y- labels
+    ax.set(title="Monte Carlo simulated stock price paths in Merton's jump \
+diffusion model\n$S_0$ = {}, $\mu$ = {}, $\sigma$ = {}, $a$ = {}, $b$ = {}, \
+$\lambda$ = {}, $T$ = {}, Nsteps = {}, Nsim = {}"\
+           .format(S, mu, sigma, a, b, Lambda, T, Nsteps, Nsim), \
+           xlabel='Time (days)', ylabel='Stock price')
+
+    # Display figure in a Python environment
+    plt.show()
+
+
 def jump_diffusion(S=1, X=0.5, T=1, mu=0.12, sigma=0.3, Lambda=0.25,
-                   a=0.2, b=0.2, Nsteps=252, Nsim=100, alpha=0.05, seed=None):
+                   a=0.2, b=0.2, Nsteps=252, Nsim=100, alpha=0.05, seed=None,
+                   processes=None, Nplot=200, use_gpu=False, plot=True):
     '''
     Monte Carlo simulation [1] of Merton's Jump Diffusion Model [2].
     The model is specified through the stochastic differential equation (SDE):
@@ -37,6 +236,24 @@ def jump_diffusion(S=1, X=0.5, T=1, mu=0.12, sigma=0.3, Lambda=0.25,
     seed: int. Set random seed, for reproducibility of the results. Default
           value is None (the best seed available is used, but outcome will vary
           in each experiment).
+    processes: int. The number of worker processes among which the Nsim
+               simulations are split. Default value is None (a single process
+               is used, with the simulations spread across all of its threads).
+               Results do not depend on the number of processes. In a script,
+               calls with processes set must be placed under an
+               if __name__ == '__main__': guard.
+    Nplot: int. The maximum number of simulated paths drawn in the figure. If
+           Nsim is larger, only the first Nplot paths are stored in full and
+           plotted (drawing all of them would dominate the running time of
+           large simulations, with no visible benefit). Default value is 200.
+    use_gpu: bool. Run the simulation on a CUDA GPU, with CuPy (which then has
+             to be installed). Worthwhile for large Nsim (100,000 or more).
+             For the same seed, results differ from those obtained on the CPU,
+             and processes is ignored. Default value is False.
+    plot: bool. Draw the simulated paths. Set it to False to skip building and
+          displaying the figure, e.g. when timing the simulation or calling
+          the function repeatedly, in which case no path is stored in full.
+          Default value is True.
 
     References
     ---------------------------------------------------------------------------
@@ -48,15 +265,8 @@ def jump_diffusion(S=1, X=0.5, T=1, mu=0.12, sigma=0.3, Lambda=0.25,
         Edition, Pearson.
     '''
 
-    # Import required libraries
-    import time
-    import numpy as np
+    # Import SciPy only here, for the same reason as in plot_paths
     from scipy import stats
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-
-    # Set random seed
-    np.random.seed(seed)
 
     '''
     Time the whole path-generating process, using a tic-toc method familiar
@@ -64,9 +274,6 @@ def jump_diffusion(S=1, X=0.5, T=1, mu=0.12, sigma=0.3, Lambda=0.25,
     '''
     tic = time.time()
 
-    # Calculate the length of the time step
-    Delta_t = T/Nsteps
-
     '''
     Compute mean and variance of a standard lognormal distribution from user
     defined parameters a and b. The latter are useful to simulate the jump
@@ -94,52 +301,29 @@ def jump_diffusion(S=1, X=0.5, T=1, mu=0.12, sigma=0.3, Lambda=0.25,
         - np.exp(2*mu*T + 2*Lambda*T*(mean_Y - 1)))
 
     '''
-    Generate an Nsim x (Nsteps+1) array of zeros to preallocate the simulated
-    paths of the Monte Carlo simulation. Each row of the matrix represents a
-    full, possible path for the stock, each column all values of the asset at
-    a particular instant in time.
+    Generate Nsim random paths of length Nsteps, storing all prices at maturity
+    T, but only the first Nplot paths in full, for the figure (none, if no
+    figure is drawn)
     '''
-    simulated_paths = np.zeros([Nsim, Nsteps+1])
-
-    # Replace the first column of the array with the vector of initial price S
-    simulated_paths[:,0] = S
+    final_prices, simulated_paths = simulate(S, T, mu, sigma, Lambda, a, b,
+                                             Nsteps, Nsim, seed, processes,
+                                             Nplot if plot else 0, use_gpu)
 
     '''
-    To account for the multiple sources of uncertainty in the jump diffusion
-    process, generate three arrays of random variables.
-
-     - The first one is related to the standard Brownian motion, the component
-       epsilon(0,1) in epsilon(0,1) * np.sqrt(dt);
-     - The second and third ones model the jump, a compound Poisson process:
-       the former (a Poisson process with intensity Lambda) causes the asset
-       price to jump randomly (random timing); the latter (a Gaussian variable)
-       defines both the direction (sign) and intensity (magnitude) of the jump.
+    Compute mean, variance, standard deviation, skewness, excess kurtosis. The
+    standard deviation is obtained from the variance, rather than with a
+    further pass over the array of terminal prices.
     '''
-    Z_1 = np.random.normal(size=[Nsim, Nsteps])
-    Z_2 = np.random.normal(size=[Nsim, Nsteps])
-    Poisson = np.random.poisson(Lambda*Delta_t, [Nsim, Nsteps])
-
-    # Populate the matrix with Nsim randomly generated paths of length Nsteps
-    for i in range(Nsteps):
-        simulated_paths[:,i+1] = simulated_paths[:,i]*np.exp((mu
-                               - sigma**2/2)*Delta_t + sigma*np.sqrt(Delta_t) \
-                               * Z_1[:,i] + a*Poisson[:,i] \
-                               + np.sqrt(b**2) * np.sqrt(Poisson[:,i]) \
-                               * Z_2[:,i])
-
-    # Single out array of simulated prices at maturity T
-    final_prices = simulated_paths[:,-1]
-
-    # Compute mean, variance, standard deviation, skewness, excess kurtosis
     mean_jump = np.mean(final_prices)
     var_jump = np.var(final_prices)
-    std_jump = np.std(final_prices)
+    std_jump = np.sqrt(var_jump)
     skew_jump = stats.skew(final_prices)
     kurt_jump = stats.kurtosis(final_prices)
 
     # Calculate confidence interval for the mean
-    ci_low = mean_jump - std_jump/np.sqrt(Nsim)*stats.norm.ppf(1-0.5*alpha)
-    ci_high = mean_jump + std_jump/np.sqrt(Nsim)*stats.norm.ppf(1-0.5*alpha)
+    half_width = std_jump/np.sqrt(Nsim) * stats.norm.ppf(1-0.5*alpha)
+    ci_low = mean_jump - half_width
+    ci_high = mean_jump + half_width
 
     # Print statistics, align results
     print("Merton's Jump Diffusion Model")
@@ -161,29 +345,10 @@ def jump_diffusion(S=1, X=0.5, T=1, mu=0.12, sigma=0.3, Lambda=0.25,
     print('Lower bound {:>17.4f}'.format(ci_low))
     print('Upper bound {:>17.4f}'.format(ci_high))
 
-    # Choose palette, figure size, and define figure axes
-    sns.set(palette='viridis')
-    plt.figure(figsize=(10,8))
-    ax = plt.axes()
-
-    # Generate t, the time variable on the abscissae
-    t = np.linspace(0, T, Nsteps+1) * Nsteps
-
-    # Plot the Monte Carlo simulated stock price paths
-    jump_diffusion = ax.plot(t, simulated_paths.transpose());
-
-    # Make drawn paths thinner by decreasing line width
-    plt.setp(jump_diffusion, linewidth=1);
-
-    # Set title (LaTeX notation) and x- and y- labels
-    ax.set(title="Monte Carlo simulated stock price paths in Merton's jump \
-diffusion model\n$S_0$ = {}, $\mu$ = {}, $\sigma$ = {}, $a$ = {}, $b$ = {}, \
-$\lambda$ = {}, $T$ = {}, Nsteps = {}, Nsim = {}"\
-           .format(S, mu, sigma, a, b, Lambda, T, Nsteps, Nsim), \
-           xlabel='Time (days)', ylabel='Stock price')
-
-    # Display figure in a Python environment
-    plt.show()
+    # Draw the simulated paths, if required
+    if plot:
+        plot_paths(simulated_paths, S, T, mu, sigma, Lambda, a, b, Nsteps,
+                   Nsim)
 
     # Time and print the elapsed time
     toc = time.time()